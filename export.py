@@ -1,13 +1,50 @@
-import base64
-import json
 import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import Callable, Dict, List, TextIO, Tuple, TypeVar
 
 import click
-import dominate
-from dominate.tags import div, h2, h3, p, ol, li, blockquote
-from dominate.util import raw
+import orjson
+import pybase64
+
+
+T = TypeVar('T')
+
+HTML_ESCAPE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&#x27;',
+})
+
+SQL_PRAGMAS = '''
+    PRAGMA cache_size = -65536;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA query_only = 1;
+'''
+
+SQL_BOOKS = 'SELECT OID, Title, Authors FROM Books'
+
+SQL_FILE_NAMES = 'SELECT BookID, Name FROM Files'
+
+SQL_ITEMS = '''
+    SELECT i.ParentID, q.Val, v.Val
+    FROM Items i
+    JOIN Tags t ON t.ItemID = i.OID
+    JOIN TagNames tn ON tn.OID = t.TagID
+    LEFT JOIN Tags q ON q.ItemID = i.OID AND q.TagID = (
+        SELECT OID FROM TagNames WHERE TagName = 'bm.quotation'
+    )
+    LEFT JOIN Tags v ON v.ItemID = i.OID AND v.TagID = (
+        SELECT OID FROM TagNames WHERE TagName = ?
+    )
+    WHERE i.State = 0
+    AND tn.TagName = 'bm.type'
+    AND t.Val = ?
+'''
 
 
 class Book:
@@ -20,38 +57,43 @@ class Book:
         self.bookmarks = []
         self.highlights = []
 
-    def render(self):
+    def render(self, out: TextIO):
         if len(self.highlights) == 0 \
                 and len(self.notes) == 0 \
                 and len(self.bookmarks) == 0:
             return
 
-        with div():
-            h2(self.title)
-            if self.authors is not None:
-                p(f'Authors: {self.authors}')
-            p(f'File: {self.file_name}')
-
-            if len(self.bookmarks) > 0:
-                h3('Bookmarks')
-                with ol():
-                    for bookmark in self.bookmarks:
-                        with li():
-                            bookmark.render()
-
-            if len(self.highlights) > 0:
-                h3('Highlights')
-                with ol():
-                    for highlight in self.highlights:
-                        with li():
-                            highlight.render()
-
-            if len(self.notes) > 0:
-                h3('Notes')
-                with ol():
-                    for note in self.notes:
-                        with li():
-                            note.render()
+        out.write('<div>')
+        out.write(f'<h2>{str(self.title).translate(HTML_ESCAPE)}</h2>')
+        if self.authors is not None:
+            out.write(f'<p>Authors: {self.authors.translate(HTML_ESCAPE)}</p>')
+        out.write(f'<p>File: {str(self.file_name).translate(HTML_ESCAPE)}</p>')
+
+        if len(self.bookmarks) > 0:
+            out.write('<h3>Bookmarks</h3><ol>')
+            for bookmark in self.bookmarks:
+                out.write('<li>')
+                bookmark.render(out)
+                out.write('</li>')
+            out.write('</ol>')
+
+        if len(self.highlights) > 0:
+            out.write('<h3>Highlights</h3><ol>')
+            for highlight in self.highlights:
+                out.write('<li>')
+                highlight.render(out)
+                out.write('</li>')
+            out.write('</ol>')
+
+        if len(self.notes) > 0:
+            out.write('<h3>Notes</h3><ol>')
+            for note in self.notes:
+                out.write('<li>')
+                note.render(out)
+                out.write('</li>')
+            out.write('</ol>')
+
+        out.write('</div>\n')
 
 
 class Highlight:
@@ -59,13 +101,14 @@ class Highlight:
         self.text = text
         self.snapshot = snapshot
 
-    def render(self):
-        with div():
-            p(self.text)
-            if self.snapshot is not None:
-                image = self.snapshot
-                b64 = base64.b64encode(image).decode('utf8')
-                raw(f'<img src="data:image/jpeg;base64,{b64}"/>')
+    def render(self, out: TextIO):
+        out.write(f'<div><p>{str(self.text).translate(HTML_ESCAPE)}</p>')
+        if self.snapshot is not None:
+            out.write('<img src="data:image/jpeg;base64,')
+            out.write(pybase64.b64encode_as_string(self.snapshot))
+            out.write('"/>')
+            self.snapshot = None
+        out.write('</div>')
 
 
 class Note:
@@ -73,10 +116,11 @@ class Note:
         self.quotation = quotation
         self.note = note
 
-    def render(self):
-        with div():
-            p(self.note)
-            blockquote(p(self.quotation))
+    def render(self, out: TextIO):
+        out.write(f'<div><p>{str(self.note).translate(HTML_ESCAPE)}</p>')
+        out.write('<blockquote>')
+        out.write(f'<p>{str(self.quotation).translate(HTML_ESCAPE)}</p>')
+        out.write('</blockquote></div>')
 
 
 class Bookmark:
@@ -85,151 +129,117 @@ class Bookmark:
         self.text = text
         self.created = created
 
-    def render(self):
-        with div():
-            p(f'Anchor: {self.anchor}')
-            p(f'Text: {self.text}')
-            p(f'Created: {self.created}')
+    def render(self, out: TextIO):
+        out.write('<div>')
+        out.write(f'<p>Anchor: {str(self.anchor).translate(HTML_ESCAPE)}</p>')
+        out.write(f'<p>Text: {str(self.text).translate(HTML_ESCAPE)}</p>')
+        out.write(f'<p>Created: {self.created}</p>')
+        out.write('</div>')
 
 
 def get_books(con: sqlite3.Connection) -> List[Book]:
     books = []
-    sql = 'SELECT * FROM Books'
-    cur = con.execute(sql)
-    for row in cur:
-        book = Book(row[0], row[1], row[2])
+    cur = con.execute(SQL_BOOKS)
+    for oid, title, authors in cur:
+        book = Book(oid, title, authors)
         books.append(book)
     return books
 
 
-def get_file_name(con: sqlite3.Connection, book_oid: int) -> str:
-    sql = 'SELECT Name FROM Files WHERE BookID=?'
-    cur = con.execute(sql, (book_oid,))
-    row = cur.fetchone()
-    if row is None:
-        return None
-    return row[0]
+def get_file_names(con: sqlite3.Connection) -> Dict[int, str]:
+    cur = con.execute(SQL_FILE_NAMES)
+    file_names = {}
+    for book_oid, name in cur:
+        file_names.setdefault(book_oid, name)
+    return file_names
 
 
 def select_items(con: sqlite3.Connection,
-                 book_oid: int,
-                 type_val: str) -> List[int]:
-    sql = '''
-        SELECT t.ItemID
-        FROM Items i
-        JOIN Tags t ON t.ItemID = i.OID
-        JOIN TagNames tn ON tn.OID = t.TagID
-        WHERE i.ParentID = ?
-        AND i.State = 0
-        AND tn.TagName = 'bm.type'
-        AND t.Val = ?
-    '''
-    cur = con.execute(sql, (book_oid, type_val))
-    item_ids = [row[0] for row in cur]
-    return item_ids
-
-
-def select_quotation(con: sqlite3.Connection, item_id: int) -> str:
-    sql = '''
-        SELECT Val
-        FROM Tags t
-        JOIN TagNames tn ON tn.OID = t.TagID
-        WHERE t.ItemId = ?
-        AND tn.TagName = 'bm.quotation'
-    '''
-    cur = con.execute(sql, (item_id,))
-    row = cur.fetchone()
-
-    if row is None:
-        return None
-
-    val = row[0]
-    o = json.loads(val)
-    return o['text']
-
-
-def select_tag_value(con: sqlite3.Connection, item_id: int, tag: str) -> str:
-    sql = '''
-        SELECT Val
-        FROM Tags t
-        JOIN TagNames tn ON tn.OID = t.TagID
-        WHERE t.ItemId = ?
-        AND tn.TagName = ?
-    '''
-    cur = con.execute(sql, (item_id, tag))
-    row = cur.fetchone()
-
-    if row is None:
-        return None
-
-    return row[0]
-
-
-def get_highlights(con: sqlite3.Connection,
-                   book_oid: int) -> List[Highlight]:
-    highlights = []
-    item_ids = select_items(con, book_oid, 'highlight')
-    for item_id in item_ids:
-        text = select_quotation(con, item_id)
-        snapshot = select_tag_value(con, item_id, 'bm.image')
-        highlight = Highlight(text, snapshot)
-        highlights.append(highlight)
+                 type_val: str,
+                 tag: str) -> Dict[int, List[Tuple[str, str]]]:
+    cur = con.execute(SQL_ITEMS, (tag, type_val))
+    items = defaultdict(list)
+    for book_oid, quotation, val in cur:
+        if quotation is not None:
+            quotation = orjson.loads(quotation)['text']
+        items[book_oid].append((quotation, val))
+    return items
+
+
+def get_all_highlights(con: sqlite3.Connection) -> Dict[int, List[Highlight]]:
+    highlights = defaultdict(list)
+    items = select_items(con, 'highlight', 'bm.image')
+    for book_oid, book_items in items.items():
+        for text, snapshot in book_items:
+            highlight = Highlight(text, snapshot)
+            highlights[book_oid].append(highlight)
     return highlights
 
 
-def get_notes(con: sqlite3.Connection,
-              book_oid: int) -> List[Note]:
-    notes = []
-    item_ids = select_items(con, book_oid, 'note')
-    for item_id in item_ids:
-        quotation = select_quotation(con, item_id)
-        val = select_tag_value(con, item_id, 'bm.note')
-        o = json.loads(val)
-        note = o['text']
-        note = Note(quotation, note)
-        notes.append(note)
+def get_all_notes(con: sqlite3.Connection) -> Dict[int, List[Note]]:
+    notes = defaultdict(list)
+    items = select_items(con, 'note', 'bm.note')
+    for book_oid, book_items in items.items():
+        for quotation, val in book_items:
+            o = orjson.loads(val)
+            note = o['text']
+            note = Note(quotation, note)
+            notes[book_oid].append(note)
     return notes
 
 
-def get_bookmarks(con: sqlite3.Connection,
-                  book_oid: int) -> List[Bookmark]:
-    bookmarks = []
-    item_ids = select_items(con, book_oid, 'bookmark')
-    for item_id in item_ids:
-        text = select_quotation(con, item_id)
-        val = select_tag_value(con, item_id, 'bm.book_mark')
-        o = json.loads(val)
-        created = datetime.fromtimestamp(o['created'])
-        anchor = o['anchor']
-        bookmark = Bookmark(anchor, text, created)
-        bookmarks.append(bookmark)
+def get_all_bookmarks(con: sqlite3.Connection) -> Dict[int, List[Bookmark]]:
+    bookmarks = defaultdict(list)
+    items = select_items(con, 'bookmark', 'bm.book_mark')
+    for book_oid, book_items in items.items():
+        for text, val in book_items:
+            o = orjson.loads(val)
+            created = datetime.fromtimestamp(o['created'])
+            anchor = o['anchor']
+            bookmark = Bookmark(anchor, text, created)
+            bookmarks[book_oid].append(bookmark)
     return bookmarks
 
 
 def export(books: List[Book], path: str):
-    doc = dominate.document(title='PocketBook 740 export')
-
-    with doc:
+    with open(path, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html>\n<head>\n')
+        f.write('<title>PocketBook 740 export</title>\n')
+        f.write('</head>\n<body>\n')
         for book in books:
-            book.render()
+            book.render(f)
+        f.write('</body>\n</html>\n')
 
-    with open(path, 'w') as f:
-        f.write(doc.render())
+
+def load(path: str, loader: Callable[[sqlite3.Connection], T]) -> T:
+    con = sqlite3.connect(path)
+    try:
+        con.executescript(SQL_PRAGMAS)
+        return loader(con)
+    finally:
+        con.close()
 
 
 @click.command()
 @click.argument('path', type=click.Path(exists=True))
 def main(path):
-    con = sqlite3.connect(path)
-    books = get_books(con)
+    loaders = (get_books, get_file_names, get_all_highlights,
+               get_all_notes, get_all_bookmarks)
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = [executor.submit(load, path, loader) for loader in loaders]
+        books, file_names, highlights, notes, bookmarks = \
+            [future.result() for future in futures]
+
+    books = [book for book in books
+             if book.oid in highlights
+             or book.oid in notes
+             or book.oid in bookmarks]
 
     for book in books:
-        book.file_name = get_file_name(con, book.oid)
-        book.highlights = get_highlights(con, book.oid)
-        book.notes = get_notes(con, book.oid)
-        book.bookmarks = get_bookmarks(con, book.oid)
-
-    con.close()
+        book.file_name = file_names.get(book.oid)
+        book.highlights = highlights.get(book.oid, [])
+        book.notes = notes.get(book.oid, [])
+        book.bookmarks = bookmarks.get(book.oid, [])
 
     export(books, 'export.html')
 